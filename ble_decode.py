@@ -8,6 +8,9 @@ import matplotlib.pyplot as plt
 from struct import pack, unpack
 
 from channelizer import PolyphaseChannelizer
+from ble_follow import ConnectionFollower
+from fused_demod import demod_sync, ble_pkt_extract_packed
+from packet_sink import PcapSink
 from ble_utils import *
 
 def main():
@@ -32,9 +35,14 @@ def main():
     chan_width = fs / chan_count
 
     channels_ble = [37, 38, 39]
-    channels_seq = [0, 12, 39]
     centre_seq = 19 # 2440 MHz
-    channels_poly = [channelizer.chan_idx(s - centre_seq) for s in channels_seq]
+    chan_row = lambda c: channelizer.chan_idx(ble_chan_rf_idx(c) - centre_seq)
+    channels_poly = [chan_row(c) for c in channels_ble]
+
+    # Only demodulate the scheduled data channel around each connection event
+    follower = ConnectionFollower(chan_width, chan_row)
+
+    sink = PcapSink("ble_capture.pcap", chan_width)
 
     print("Channelizing and processing")
     t0 = time()
@@ -42,9 +50,12 @@ def main():
     # smaller chunk sizes get worse performance, below 2^20 is dramatically worse
     # bigger chunk sizes also actually get a little worse on my Mac
     chunk_sz = 1 << 22
+    samp_idx = 0
     for i in range(0, len(samples), chunk_sz):
         channelized = channelizer.process(samples[i:i + chunk_sz])
-        process_channels(channelized, chan_width, channels_ble, channels_poly)
+        process_channels(channelized, samp_idx, channels_ble, channels_poly, follower, sink)
+        samp_idx += channelized.shape[1]
+    sink.close()
     t1 = time()
     print("Processed %.3f s of samples in %.3f s" % (len(samples) / fs, t1 - t0))
     print("Found %d, failed %d" % (found, failed))
@@ -52,17 +63,26 @@ def main():
 found = 0
 failed = 0
 
-def process_channels(channelized, fs, channels_ble, channels_poly):
+def process_channels(channelized, samp_idx, channels_ble, channels_poly, follower, sink):
     global found, failed
 
+    records = []
     for i, chan in enumerate(channels_ble):
         samples = channelized[channels_poly[i]]
-        samples_demod = fm_demod(samples) > 0
-        peaks = find_sync_multi2(samples_demod, b'\xd6\xbe\x89\x8e')
-        pkts = ble_pkt_extract(samples_demod, peaks, chan)
-        for pkt in pkts:
-            print(chan, hex_str(pkt))
-            found += 1
+        packed, peaks = demod_sync(samples, b'\xd6\xbe\x89\x8e')
+        for p in peaks:
+            for pkt in ble_pkt_extract_packed(packed, len(samples), [p], chan):
+                signal = signal_dbfs(samples[p:p + (4 + len(pkt)) * 8 * 2])
+                records.append((chan, samp_idx + p, pkt, 0x8E89BED6, signal))
+                conn = follower.on_adv_packet(pkt, samp_idx + p)
+                if conn is not None:
+                    print("Following connection AA %08x" % conn.aa)
+
+    for conn, chan, aa_start, pkt, signal in follower.process(channelized, samp_idx):
+        records.append((chan, aa_start, pkt, conn.aa, signal))
+
+    sink.write_batch(records)
+    found += len(records)
 
     """
     print("Plotting")
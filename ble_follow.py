@@ -0,0 +1,222 @@
+# Written by Sultan Qasim Khan
+# Copyright (c) 2024, NCC Group plc
+# Released as open source under GPLv3
+
+import numpy
+from struct import pack, unpack
+
+from fused_demod import MAX_PKT, demod_sync, ble_pkt_extract_packed
+from ble_utils import le_crc, signal_dbfs
+
+# Sleep clock accuracy field to worst case ppm
+SCA_PPM = [500, 250, 150, 100, 75, 50, 30, 20]
+
+# Our own clock error allowance (ppm)
+LOCAL_PPM = 50
+
+def parse_connect_ind(pkt):
+    # pkt is a dewhitened advertising PDU (header + body + CRC) as returned by ble_pkt_extract
+    # Returns a dict of connection parameters, or None if pkt is not a valid CONNECT_IND
+    if len(pkt) < 39 or pkt[0] & 0x0F != 0x05 or pkt[1] != 34:
+        return None
+    if le_crc(pkt[:36]) != int.from_bytes(pkt[36:39], 'little'):
+        return None
+
+    body = pkt[2:36]
+    ll = body[12:]
+    aa, = unpack('<I', ll[0:4])
+    win_offset, interval, latency, timeout = unpack('<HHHH', ll[8:16])
+    chm = int.from_bytes(ll[16:21], 'little')
+    chan_map = [c for c in range(37) if chm & (1 << c)]
+    hop = ll[21] & 0x1F
+    csa2 = bool(pkt[0] & 0x20)
+
+    # Reject out of spec parameters, which would otherwise break event scheduling
+    if not 6 <= interval <= 3200 or timeout == 0 or len(chan_map) < 2:
+        return None
+    if not csa2 and not 5 <= hop <= 16:
+        return None
+
+    return {
+        'init_addr': body[0:6][::-1].hex(':'),
+        'adv_addr': body[6:12][::-1].hex(':'),
+        'aa': aa,
+        'crc_init': int.from_bytes(ll[4:7], 'little'),
+        'win_size': ll[7],
+        'win_offset': win_offset,
+        'interval': interval,
+        'latency': latency,
+        'timeout': timeout,
+        'chan_map': chan_map,
+        'hop': hop,
+        'sca': ll[21] >> 5,
+        'csa2': csa2,
+    }
+
+def csa1_channel(event_counter, hop, chan_map):
+    # Channel Selection Algorithm #1 (closed form of lastUnmappedChannel + hop)
+    unmapped = ((event_counter + 1) * hop) % 37
+    if unmapped in chan_map:
+        return unmapped
+    return chan_map[unmapped % len(chan_map)]
+
+def _perm(v):
+    # reverse bits within each byte of a 16 bit value
+    lo = int('{:08b}'.format(v & 0xFF)[::-1], 2)
+    hi = int('{:08b}'.format(v >> 8)[::-1], 2)
+    return (hi << 8) | lo
+
+def csa2_channel(event_counter, aa, chan_map):
+    # Channel Selection Algorithm #2
+    chan_id = ((aa >> 16) ^ aa) & 0xFFFF
+    v = event_counter ^ chan_id
+    for i in range(3):
+        v = (17 * _perm(v) + chan_id) & 0xFFFF
+    prn_e = v ^ chan_id
+
+    unmapped = prn_e % 37
+    if unmapped in chan_map:
+        return unmapped
+    return chan_map[(len(chan_map) * prn_e) >> 16]
+
+class BLEConnection:
+    def __init__(self, params: dict, conn_ind_end: int, fs: float):
+        # conn_ind_end is the sample index at which the CONNECT_IND packet ended
+        self.params = params
+        self.aa = params['aa']
+        self.aa_bytes = pack('<I', self.aa)
+        self.chan_map = params['chan_map']
+        self.fs = fs
+
+        us = fs / 1E6
+        self.interval_samps = params['interval'] * 1250 * us
+        self.timeout_samps = params['timeout'] * 10000 * us
+        self.drift = (SCA_PPM[params['sca']] + LOCAL_PPM) / 1E6
+
+        # Anchor point of event 0 lies within the transmit window
+        # We track AA start rather than preamble start, hence the 8 us
+        self.anchor = conn_ind_end + (1250 + params['win_offset'] * 1250 + 8) * us
+        self.anchor_event = 0
+        self.anchor_uncert = params['win_size'] * 1250 * us
+
+        self.event = 0
+        self.last_seen = conn_ind_end
+        self.pkt_count = 0
+
+    def channel(self, event_counter: int) -> int:
+        if self.params['csa2']:
+            return csa2_channel(event_counter & 0xFFFF, self.aa, self.chan_map)
+        else:
+            return csa1_channel(event_counter, self.params['hop'], self.chan_map)
+
+    def event_window(self, event_counter: int, window: float) -> tuple:
+        # Sample index range in which the AA of the first packet of the event may start
+        nominal = self.anchor + (event_counter - self.anchor_event) * self.interval_samps
+        widening = self.drift * (nominal - self.anchor) + window
+        return int(nominal - widening), int(nominal + self.anchor_uncert + widening) + 1
+
+    def observe(self, event_counter: int, aa_start: int):
+        # Re-anchor timing on the first packet seen in an event
+        self.anchor = aa_start
+        self.anchor_event = event_counter
+        self.anchor_uncert = 0
+        self.last_seen = aa_start
+        self.pkt_count += 1
+
+    def expired(self, samp_idx: int) -> bool:
+        return samp_idx - self.last_seen > self.timeout_samps
+
+class ConnectionFollower:
+    def __init__(self, fs: float, chan_row, window_us: float = 32, samps_per_sym: int = 2):
+        # Follows connections from CONNECT_IND, demodulating only each event's scheduled channel
+        # chan_row maps a BLE channel index to a channelizer output row
+        # Connection and channel map updates are not tracked
+        self.fs = fs
+        self.chan_row = chan_row
+        self.window = window_us * fs / 1E6
+        self.samps_per_sym = samps_per_sym
+        self.max_pkt_samps = MAX_PKT * 8 * samps_per_sym
+        self.connections = {}
+
+        # Previous channelized chunk, so windows straddling chunk boundaries can be decoded
+        self.prev = None
+
+    def on_adv_packet(self, pkt: bytes, aa_start: int):
+        params = parse_connect_ind(pkt)
+        if params is None:
+            return None
+
+        # AA + header + body + CRC, 1 us per symbol
+        conn_ind_end = aa_start + (4 + len(pkt)) * 8 * self.samps_per_sym
+        conn = BLEConnection(params, conn_ind_end, self.fs)
+        self.connections[params['aa']] = conn
+        return conn
+
+    def process(self, channelized: numpy.ndarray, chunk_start: int) -> list:
+        # channelized holds samples [chunk_start, chunk_start + n) for every channelizer row
+        # Returns a list of (connection, BLE channel, AA start sample index, packet, signal dBFS)
+        chunk_end = chunk_start + channelized.shape[1]
+        if self.prev is not None and self.prev.shape[1] > 0:
+            hist_start = chunk_start - self.prev.shape[1]
+        else:
+            hist_start = chunk_start
+
+        pkts = []
+        for aa, conn in list(self.connections.items()):
+            while True:
+                a, b = conn.event_window(conn.event, self.window)
+                stop = b + self.max_pkt_samps
+                if stop > chunk_end:
+                    # wait for the next chunk
+                    break
+                if b <= hist_start:
+                    # window has already passed
+                    conn.event += 1
+                    continue
+                a = max(a, hist_start)
+
+                chan = conn.channel(conn.event)
+                samples = self._window(channelized, self.chan_row(chan), chunk_start,
+                                       hist_start, a, stop)
+                pkts.extend(self._decode_event(conn, chan, samples, a, b))
+                conn.event += 1
+
+            if conn.expired(chunk_end):
+                del self.connections[aa]
+
+        self.prev = channelized
+        return pkts
+
+    def _window(self, channelized, row, chunk_start, hist_start, a, b):
+        if a >= chunk_start:
+            return channelized[row, a - chunk_start:b - chunk_start]
+        elif b <= chunk_start:
+            return self.prev[row, a - hist_start:b - hist_start]
+        else:
+            return numpy.concatenate([self.prev[row, a - hist_start:],
+                                      channelized[row, :b - chunk_start]])
+
+    def _decode_event(self, conn, chan, samples, a, b):
+        # The first packet must start within the anchor window [a, b), and re-anchors timing
+        # Later packets of the event (at the inter frame spacing) are kept if they fall
+        # within the demodulated span
+        packed, peaks = demod_sync(samples, conn.aa_bytes, self.samps_per_sym)
+
+        pkts = []
+        pkt_end = 0
+        for p in peaks:
+            if not pkts and p >= b - a:
+                break
+            if p < pkt_end:
+                continue
+            for pkt in ble_pkt_extract_packed(packed, len(samples), [p], chan, self.samps_per_sym):
+                # drop corrupted packets and false AA matches
+                if len(pkt) < 5 or le_crc(pkt[:-3], conn.params['crc_init']) != \
+                        int.from_bytes(pkt[-3:], 'little'):
+                    continue
+                if not pkts:
+                    conn.observe(conn.event, a + p)
+                pkt_end = p + (4 + len(pkt)) * 8 * self.samps_per_sym
+                signal = signal_dbfs(samples[p:pkt_end])
+                pkts.append((conn, chan, a + p, pkt, signal))
+        return pkts
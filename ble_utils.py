@@ -78,6 +78,49 @@ def fsk_decode(capture, fs, sym_rate, clock_recovery=False, cfo=0):
 
     return digital_demod[indices]
 
+def _fm_demod_at(samples, starts, indices):
+    # fm_demod of the bursts beginning at starts in samples, evaluated only at indices
+    # (relative to each burst start)
+    cur = samples[starts[:, None] + indices]
+    prev = numpy.where(indices == 0, 0, samples[starts[:, None] + indices - 1])
+    i = numpy.real(cur)
+    q = numpy.imag(cur)
+    idot = i - numpy.real(prev)
+    qdot = q - numpy.imag(prev)
+    sq = numpy.square(i) + numpy.square(q)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return (i*qdot - q*idot) / sq
+
+def fsk_decode_batch(captures, fs, sym_rate, clock_recovery=False, cfo=0):
+    # Same as fsk_decode, but for a list of bursts processed together in 2-D arrays
+    # Only the samples that become symbols (or are used for clock recovery) are demodulated
+    # Returns (symbols, symbol counts), where symbols is 2-D and zero past each row's count
+    lens = numpy.array([len(c) for c in captures], numpy.int64)
+    starts = numpy.cumsum(lens) - lens
+    samples = numpy.concatenate(captures) if len(captures) else numpy.zeros(0, numpy.complex64)
+    max_len = max(lens, default=0)
+
+    samps_per_sym = fs / sym_rate
+    offsets = numpy.zeros(len(captures), numpy.int64)
+    if clock_recovery:
+        skip = int(samps_per_sym * 3)
+        usable = lens > skip * 2
+        if numpy.any(usable):
+            window = numpy.arange(skip, skip * 2)[None, :]
+            offsets[usable] = skip + numpy.argmax(_fm_demod_at(samples, starts[usable], window), axis=1)
+
+    # convert from Carrier Frequency Offset (CFO) in Hz to radians per sample error
+    demod_offset = cfo * 2 * numpy.pi / fs
+
+    max_syms = int(numpy.ceil(max_len / samps_per_sym)) + 1
+    positions = offsets[:, None] + numpy.arange(max_syms) * samps_per_sym
+    valid = positions < lens[:, None]
+    indices = numpy.where(valid, positions, 0).astype(numpy.int64)
+
+    syms = numpy.array(_fm_demod_at(samples, starts, indices) > demod_offset, numpy.uint8)
+    syms[~valid] = 0
+    return syms, numpy.sum(valid, axis=1)
+
 def find_sync_multi(samples_demod, sync, big_endian=False, corr_thresh=2, samps_per_sym=2):
     if big_endian:
         seq = numpy.unpackbits(numpy.frombuffer(sync, numpy.uint8), bitorder='big')
@@ -104,7 +147,7 @@ def find_sync_multi2(samples_demod, sync, samps_per_sym=2):
     for i in range(samps_per_sym):
         syms = numpy.packbits(samples_demod[i::samps_per_sym], bitorder='little').tobytes()
         for j, seq in enumerate(sync_seqs):
-            indices.extend([((m.start() - 1)*8 + j)*samps_per_sym + i for m in re.finditer(seq, syms)])
+            indices.extend([((m.start() - 1)*8 + j)*samps_per_sym + i for m in re.finditer(re.escape(seq), syms)])
 
     # deduplicate
     indices.sort()
@@ -149,9 +192,38 @@ def find_sync32(syms, sync_word=0x8E89BED6):
     sync = pack('<I', sync_word)
     return find_sync(syms, sync)
 
+def find_sync32_batch(syms, sym_counts, sync_word=0x8E89BED6, corr_thresh=2):
+    # Same as find_sync32 for every row of syms (as returned by fsk_decode_batch)
+    # Returns an array of sync offsets, with -1 for rows where sync was not found
+    seq = numpy.unpackbits(numpy.frombuffer(pack('<I', sync_word), numpy.uint8), bitorder='little')
+    seq_signed = ((2 * seq.astype(numpy.int8)) - 1)
+
+    # padding is 0 rather than +/-1 so it never contributes to the correlation
+    cols = max(syms.shape[1], len(seq))
+    syms_signed = numpy.zeros((syms.shape[0], cols), numpy.int8)
+    valid = numpy.arange(syms.shape[1]) < numpy.asarray(sym_counts)[:, None]
+    syms_signed[:, :syms.shape[1]] = numpy.where(valid, (2 * syms.astype(numpy.int8)) - 1, 0)
+
+    # correlate by summing shifted copies, which is much faster than a windowed int8 matmul
+    corr = numpy.zeros((syms.shape[0], cols - len(seq) + 1), numpy.int16)
+    for k, s in enumerate(seq_signed):
+        corr += s * syms_signed[:, k:k + corr.shape[1]]
+
+    # the sync word must lie entirely within the row's symbols, as with find_sync
+    last = numpy.asarray(sym_counts)[:, None] - len(seq)
+    corr[numpy.arange(corr.shape[1]) > last] = numpy.iinfo(numpy.int16).min
+    pos = numpy.argmax(corr, axis=1)
+    found = corr[numpy.arange(len(pos)), pos] >= len(seq) - corr_thresh
+    return numpy.where(found, pos, -1)
+
 def unpack_syms(syms, start_offset):
     return numpy.packbits(syms[start_offset:], bitorder='little')
 
+def signal_dbfs(samples):
+    # Mean power of the samples, in dB relative to full scale
+    power = numpy.mean(numpy.real(samples)**2 + numpy.imag(samples)**2)
+    return float(10 * numpy.log10(power + 1E-20))
+
 def hex_str(b):
     chars = ["%02x" % c for c in b]
     return " ".join(chars)
@@ -189,7 +261,33 @@ def le_dewhiten(data, chan):
 
 	return bytes(dw)
 
+def le_crc(data, crc_init=0x555555):
+    # BLE CRC-24 over data, as the 24 bit little endian value of the 3 CRC bytes on air
+    # crc_init is 0x555555 for advertising channel packets
+    state = int('{:024b}'.format(crc_init)[::-1], 2)
+    for b in data:
+        for i in range(8):
+            next_bit = (state ^ (b >> i)) & 1
+            state >>= 1
+            if next_bit:
+                state |= 1 << 23
+                state ^= 0x5A6000
+    return state
+
 def le_trim_pkt(data):
     # 2 bytes header, n byte body, 3 byte CRC
     l = 2 + data[1] + 3
     return data[:l]
+
+def ble_chan_rf_idx(chan):
+    # Maps BLE channel index (0-39) to RF channel index, where frequency is 2402 + 2*idx MHz
+    if chan == 37:
+        return 0
+    elif chan == 38:
+        return 12
+    elif chan == 39:
+        return 39
+    elif chan <= 10:
+        return chan + 1
+    else:
+        return chan + 2
@@ -8,53 +8,125 @@ import scipy.fft
 import concurrent.futures
 import os
 
+# Rough cost model for choosing between direct and FFT filtering, in ns per output sample
+# per polyphase branch (measured with NumPy/SciPy on x86-64). numpy.convolve has a high
+# fixed cost per output (it promotes to complex128 as the coefficients are float64) plus a
+# per-tap cost. Overlap-save is dominated by the copies and FFTs over each nfft point
+# segment, of which only nfft - taps + 1 points are kept, plus some per call overhead.
+DIRECT_COST_FIXED = 45
+DIRECT_COST_PER_TAP = 0.22
+FFT_COST_PER_POINT = 16
+FFT_COST_PER_POINT_LOG2 = 0.7
+FFT_COST_PER_CALL = 100000
+
+def filter_costs(channel_count: int, taps_per_chan: int, output_len: int) -> tuple:
+    # Returns (direct cost, FFT cost, FFT size) in ns for filtering output_len samples per branch
+    direct = channel_count * output_len * (DIRECT_COST_FIXED + DIRECT_COST_PER_TAP * taps_per_chan)
+
+    best_fft = None
+    best_nfft = None
+    nfft = 1 << max(6, (2 * taps_per_chan - 1).bit_length())
+    while True:
+        step = nfft - taps_per_chan + 1
+        segments = -(-output_len // step)
+        cost = FFT_COST_PER_CALL + channel_count * segments * nfft * (
+                FFT_COST_PER_POINT + FFT_COST_PER_POINT_LOG2 * numpy.log2(nfft))
+        if best_fft is None or cost < best_fft:
+            best_fft = cost
+            best_nfft = nfft
+        # no point in going beyond one segment
+        if step >= output_len:
+            break
+        nfft *= 2
+
+    return direct, best_fft, best_nfft
+
 class PolyphaseChannelizer:
     def __init__(self, channel_count: int, taps_per_chan: int = 16, chan_rel_bw: float = 0.8,
-                 dtype: numpy.typing.DTypeLike = numpy.complex64):
+                 dtype: numpy.typing.DTypeLike = numpy.complex64, backend: str = 'auto',
+                 n_rx: int = None, workers: int = None):
+        # backend is 'direct' (numpy.convolve per branch), 'fft' (batched overlap-save),
+        # or 'auto' to pick using the cost model for each chunk size
+        # n_rx is the number of receive channels processed together, given to process() as an
+        # (n_rx x samples) array and returned as (n_rx x channel_count x samples), with separate
+        # filter state for each. None processes a single 1-D stream.
+        # workers is the number of threads used for filtering and FFTs (default: all CPUs)
+        if backend not in ('auto', 'direct', 'fft'):
+            raise ValueError("Unknown filter backend %s" % backend)
         chan_bw = 1 /  channel_count
         filter_coeffs = scipy.signal.firwin(channel_count * taps_per_chan,
                                           chan_bw * chan_rel_bw,
                                           width=chan_bw * (1 - chan_rel_bw))
 
         self.channel_count = channel_count
+        self.taps_per_chan = taps_per_chan
+        self.backend = backend
+        self.n_rx = n_rx
+        self.workers = workers or os.cpu_count()
+        rows = 1 if n_rx is None else n_rx
         self.filter_coeffs = numpy.reshape(filter_coeffs, (channel_count, -1), order='F')
-        self.filter_ic = numpy.zeros(channel_count * (taps_per_chan - 1), dtype=dtype)
+
+        # output_len -> FFT size (or None for direct filtering), and FFT size -> filter spectra
+        self._plans = {}
+        self._filter_fft_coeffs = {}
+        # All state has a leading axis for the receive channel
+        self.filter_ic = numpy.zeros((rows, channel_count * (taps_per_chan - 1)), dtype=dtype)
 
         # first column of data for rows (channels) other than the first
-        self.extra = numpy.zeros(channel_count - 1, dtype=dtype)
+        self.extra = numpy.zeros((rows, channel_count - 1), dtype=dtype)
 
         # Any data from the end of the last chunk that wasn't a multiple of channel_count
         self.leftover = None
 
+        # Created on first use of direct filtering, and reused for every chunk after
+        self._executor = None
+
     def process(self, samples: numpy.typing.ArrayLike) -> numpy.ndarray:
+        if self.n_rx is None:
+            samples = numpy.reshape(samples, (1, -1))
+
         # amount of samples we process per operation must be a multiple of channel count
         if self.leftover is not None:
-            samples = numpy.hstack([self.filter_ic, self.leftover, samples])
+            samples = numpy.concatenate([self.filter_ic, self.leftover, samples], axis=1)
             self.leftover = None
         else:
-            samples = numpy.hstack([self.filter_ic, samples])
+            samples = numpy.concatenate([self.filter_ic, samples], axis=1)
 
-        leftover_samps = len(samples) % self.channel_count
+        leftover_samps = samples.shape[1] % self.channel_count
         if leftover_samps:
-            self.leftover = samples[-leftover_samps:]
-            samples = samples[:-leftover_samps]
-
-        output_len = (len(samples) - len(self.filter_ic)) // self.channel_count
-        self.filter_ic = samples[-len(self.filter_ic):]
-
-        filtered_samps = numpy.empty((self.channel_count, output_len + 1), dtype=samples.dtype)
-        filtered_samps[1:, 0] = self.extra
-        self.extra = filtered_samps[1:, -1]
-
-        # Do the filtering in a thread pool
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
-        futures = []
-        for i in range(self.channel_count):
-            futures.append(executor.submit(self._filter, i, samples, filtered_samps))
-        concurrent.futures.wait(futures)
+            self.leftover = samples[:, -leftover_samps:]
+            samples = samples[:, :-leftover_samps]
+
+        ic_len = self.filter_ic.shape[1]
+        output_len = (samples.shape[1] - ic_len) // self.channel_count
+        self.filter_ic = samples[:, samples.shape[1] - ic_len:]
+
+        filtered_samps = numpy.empty((samples.shape[0], self.channel_count, output_len + 1),
+                                     dtype=samples.dtype)
+        filtered_samps[:, 1:, 0] = self.extra
+        self.extra = filtered_samps[:, 1:, -1]
+
+        nfft = self._plan(output_len)
+        if nfft:
+            self._filter_fft(samples, filtered_samps, nfft)
+        elif self.workers == 1:
+            for r in range(samples.shape[0]):
+                for i in range(self.channel_count):
+                    self._filter(i, samples[r], filtered_samps[r])
+        else:
+            # Do the filtering in a thread pool
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+            futures = []
+            for r in range(samples.shape[0]):
+                for i in range(self.channel_count):
+                    futures.append(self._executor.submit(self._filter, i, samples[r], filtered_samps[r]))
+            concurrent.futures.wait(futures)
 
         # Let SciPy parallelize the FFTs
-        return scipy.fft.ifft(filtered_samps[:, :-1], axis=0, norm='forward', workers=os.cpu_count())
+        channelized = scipy.fft.ifft(filtered_samps[:, :, :-1], axis=1, norm='forward',
+                                     workers=self.workers)
+        return channelized[0] if self.n_rx is None else channelized
 
     def _filter(self, i, samples, dst):
         # For columns to line up properly:
@@ -67,6 +139,49 @@ class PolyphaseChannelizer:
         else:
             dst[i, 1:] = numpy.convolve(samples[self.channel_count - i::self.channel_count], self.filter_coeffs[i], mode='valid')
 
+    def _plan(self, output_len):
+        if output_len not in self._plans:
+            branches = self.channel_count * (1 if self.n_rx is None else self.n_rx)
+            direct, fft, nfft = filter_costs(branches, self.taps_per_chan, output_len)
+            if self.backend == 'direct' or (self.backend == 'auto' and direct <= fft):
+                nfft = None
+            self._plans[output_len] = nfft
+        return self._plans[output_len]
+
+    def _filter_fft(self, samples, dst, nfft):
+        # Overlap-save fast convolution of all branches of all receive channels at once
+        # Produces the same result as _filter for every branch
+        R = samples.shape[0]
+        M = self.channel_count
+        taps = self.taps_per_chan
+        output_len = dst.shape[2] - 1
+        step = nfft - taps + 1
+        segments = -(-output_len // step)
+
+        if nfft not in self._filter_fft_coeffs:
+            self._filter_fft_coeffs[nfft] = scipy.fft.fft(self.filter_coeffs, nfft, axis=1).astype(
+                    samples.dtype)[:, None, :]
+        coeffs_fft = self._filter_fft_coeffs[nfft]
+
+        # Branch i is every M-th sample starting from (M - i) % M, as in _filter
+        branches = numpy.zeros((R, M, segments * step + taps - 1), dtype=samples.dtype)
+        cols = numpy.reshape(samples, (R, -1, M))
+        branches[:, 0, :cols.shape[1]] = cols[:, :, 0]
+        branches[:, 1:, :cols.shape[1]] = numpy.transpose(cols[:, :, :0:-1], (0, 2, 1))
+
+        # Overlapping segments of nfft samples, each advancing by step
+        stride = branches.strides[2]
+        segs = numpy.lib.stride_tricks.as_strided(branches, (R, M, segments, nfft),
+                                                  branches.strides[:2] + (step * stride, stride),
+                                                  writeable=False)
+        spectra = scipy.fft.fft(segs, axis=3, workers=self.workers)
+        spectra *= coeffs_fft
+        filtered = scipy.fft.ifft(spectra, axis=3, overwrite_x=True, workers=self.workers)
+        filtered = numpy.reshape(filtered[:, :, :, taps - 1:], (R, M, -1))
+
+        dst[:, 0, :-1] = filtered[:, 0, :output_len]
+        dst[:, 1:, 1:] = filtered[:, 1:, :output_len]
+
     def chan_idx(self, chan: int) -> int:
         # Maps from a channel index (signed int relative to centre) to index in channelizer output array
         # Odd channel count (ex. 5):  maps -2 -1 0 1 2 to 3 4 0 1 2
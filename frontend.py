@@ -0,0 +1,80 @@
+# Written by Sultan Qasim Khan
+# Copyright (c) 2024, NCC Group plc
+# Released as open source under GPLv3
+
+import numpy
+import scipy.signal
+
+from ble_utils import burst_detect
+
+class DecimatingFrontEnd:
+    def __init__(self, fs: float, decim: int = 4, cutoff: float = 1E6, order: int = 3,
+                 post_decim: int = 2, taps_per_phase: int = 16):
+        # FIR decimation by decim, Butterworth lowpass, then decimation by post_decim
+        # Filter state is carried over, so chunks of any length give the same output
+        self.decim = decim
+        self.post_decim = post_decim
+        self.fs_out = fs / decim / post_decim
+
+        # Passband up to 80% of the decimated Nyquist frequency
+        self.fir = scipy.signal.firwin(decim * taps_per_phase + 1, 0.8 / decim).astype(numpy.float32)
+
+        # Enough history for a full filter span, kept as a multiple of decim so that
+        # upfirdn output positions line up with the decimation phase
+        self.hist_len = -(-(len(self.fir) - 1) // decim) * decim
+        self.hist = numpy.zeros(self.hist_len, numpy.complex64)
+
+        self.sos = scipy.signal.butter(order, cutoff, fs=fs / decim, output='sos').astype(numpy.float32)
+        self.zi = numpy.zeros((self.sos.shape[0], 2), numpy.complex64)
+        self.post_phase = 0
+
+    def process(self, samples: numpy.ndarray) -> numpy.ndarray:
+        buf = numpy.concatenate([self.hist, numpy.asarray(samples, numpy.complex64)])
+
+        # Outputs are at buf indices that are multiples of decim, of which those before
+        # hist_len were already produced by the previous call
+        count = -(-len(buf) // self.decim) - self.hist_len // self.decim
+        first = self.hist_len // self.decim
+        decimated = scipy.signal.upfirdn(self.fir, buf, 1, self.decim)[first:first + count]
+        self.hist = buf[count * self.decim:]
+        if count == 0:
+            return decimated
+
+        filtered, self.zi = scipy.signal.sosfilt(self.sos, decimated, zi=self.zi)
+        out = filtered[self.post_phase::self.post_decim]
+        self.post_phase = (self.post_phase - len(filtered)) % self.post_decim
+        return out
+
+class BurstCollector:
+    def __init__(self, thresh: float = 0.01, pad: int = 4, max_pending: int = 1 << 20):
+        # Bursts still in progress at the end of a chunk are carried over to the next one,
+        # unless more than max_pending samples have built up
+        self.thresh = thresh
+        self.pad = pad
+        self.max_pending = max_pending
+        self.pending = numpy.zeros(0, numpy.complex64)
+        self.pending_idx = 0
+
+    def process(self, samples: numpy.ndarray) -> tuple:
+        # Returns (list of complete bursts, list of their starting sample indices)
+        self.pending = numpy.concatenate([self.pending, samples])
+        ranges = burst_detect(self.pending, self.thresh, self.pad)
+
+        keep = len(self.pending)
+        if ranges and ranges[-1][1] >= len(self.pending) and len(self.pending) < self.max_pending:
+            keep = ranges.pop()[0]
+
+        bursts = [self.pending[a:b] for a, b in ranges]
+        starts = [self.pending_idx + a for a, b in ranges]
+        self.pending = self.pending[keep:]
+        self.pending_idx += keep
+        return bursts, starts
+
+    def flush(self) -> tuple:
+        # Returns the burst still pending at the end of the stream, in the same form as process()
+        if len(self.pending) == 0:
+            return [], []
+        bursts, starts = [self.pending], [self.pending_idx]
+        self.pending_idx += len(self.pending)
+        self.pending = numpy.zeros(0, numpy.complex64)
+        return bursts, starts
@@ -0,0 +1,188 @@
+# Written by Sultan Qasim Khan
+# Copyright (c) 2024, NCC Group plc
+# Released as open source under GPLv3
+
+# Fused FM demodulation, bit slicing and sync word search
+#
+# Equivalent to fm_demod(samples) > 0 followed by per-phase packbits and a sync search,
+# but without the ~10 full length temporaries that path allocates. Sliced bits are
+# returned packed (one row per symbol phase, little endian bit order), and sync hits
+# are returned as sample indices of the first bit of the sync word.
+#
+# Unlike find_sync_multi2 (which only compares 24 bits of the sync word at each
+# alignment), all 32 bits must match.
+
+import numpy
+import re
+from struct import unpack
+
+from ble_utils import le_dewhiten
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# 4 byte AA, 2 byte header, 255 byte body, 3 byte CRC (same limit as ble_pkt_extract)
+MAX_PKT = 264
+
+def _phase_len(n, phase, samps_per_sym):
+    return (n - phase + samps_per_sym - 1) // samps_per_sym
+
+def _packed_shape(n, samps_per_sym):
+    return (samps_per_sym, (_phase_len(n, 0, samps_per_sym) + 7) // 8)
+
+def _dedup(hits, samps_per_sym):
+    # same rule as find_sync_multi2: drop hits within samps_per_sym of the previous one
+    last_index = -samps_per_sym
+    hits2 = []
+    for i in hits:
+        if i - last_index < samps_per_sym: continue
+        hits2.append(i)
+        last_index = i
+    return hits2
+
+def demod_sync_numpy(samples, sync: bytes, samps_per_sym=2, prev=numpy.complex64(0)):
+    i = numpy.real(samples)
+    q = numpy.imag(samples)
+    idot = numpy.diff(i, prepend=numpy.real(prev))
+    qdot = numpy.diff(q, prepend=numpy.imag(prev))
+    bits = (i*qdot - q*idot) > 0
+
+    packed = numpy.zeros(_packed_shape(len(samples), samps_per_sym), numpy.uint8)
+    sync_word = unpack('<I', sync)[0]
+
+    # 24 bit patterns for each of the 8 bit alignments, as in find_sync_multi2
+    sync_bits = numpy.unpackbits(numpy.frombuffer(sync, numpy.uint8), bitorder='little')
+    sync_seqs = [numpy.packbits(sync_bits[8-j:32-j], bitorder='little').tobytes() for j in range(8)]
+
+    # A lookahead is needed to find overlapping matches, but is much slower, so only
+    # use it for patterns that can overlap themselves
+    patterns = []
+    for seq in sync_seqs:
+        if seq[1:] == seq[:-1] or seq[2:] == seq[:1]:
+            patterns.append(b'(?=' + re.escape(seq) + b')')
+        else:
+            patterns.append(re.escape(seq))
+
+    hits = []
+    for ph in range(samps_per_sym):
+        n_syms = _phase_len(len(samples), ph, samps_per_sym)
+        p = numpy.packbits(bits[ph::samps_per_sym], bitorder='little')
+        packed[ph, :len(p)] = p
+        row = p.tobytes()
+
+        cands = []
+        for j, pattern in enumerate(patterns):
+            cands.extend((m.start() - 1)*8 + j for m in re.finditer(pattern, row))
+        cands = numpy.array(cands, numpy.int64)
+        cands = cands[(cands >= 0) & (cands + 32 <= n_syms)]
+
+        # confirm all 32 bits at each candidate
+        padded = numpy.concatenate([p, numpy.zeros(5, numpy.uint8)])
+        byte_idx = cands >> 3
+        words = numpy.zeros(len(cands), numpy.uint64)
+        for b in range(5):
+            words |= padded[byte_idx + b].astype(numpy.uint64) << numpy.uint64(8*b)
+        words = (words >> (cands & 7).astype(numpy.uint64)) & numpy.uint64(0xFFFFFFFF)
+        hits.extend((cands[words == sync_word] * samps_per_sym + ph).tolist())
+
+    hits.sort()
+    return packed, _dedup(hits, samps_per_sym)
+
+if numba is not None:
+    @numba.njit(cache=True, nogil=True)
+    def _demod_sync_kernel(samples, prev_i, prev_q, sync_word, samps_per_sym, packed, hits):
+        regs = numpy.zeros(samps_per_sym, numpy.uint32)
+        acc = numpy.zeros(samps_per_sym, numpy.uint32)
+        nhits = 0
+        last_index = -samps_per_sym
+        ph = 0
+        k = 0
+        for n in range(len(samples)):
+            a = samples[n].real
+            b = samples[n].imag
+            idot = a - prev_i
+            qdot = b - prev_q
+            prev_i = a
+            prev_q = b
+
+            bit = numpy.uint32(1) if a*qdot - b*idot > 0 else numpy.uint32(0)
+            # accumulate a byte per phase before storing it
+            acc[ph] |= bit << numpy.uint32(k & 7)
+            if k & 7 == 7:
+                packed[ph, k >> 3] = acc[ph]
+                acc[ph] = 0
+
+            reg = (regs[ph] >> numpy.uint32(1)) | (bit << numpy.uint32(31))
+            regs[ph] = reg
+            if reg == sync_word and k >= 31:
+                start = n - 31 * samps_per_sym
+                if start - last_index >= samps_per_sym:
+                    # keep counting past the end so the caller can retry with more space
+                    if nhits < len(hits):
+                        hits[nhits] = start
+                    nhits += 1
+                    last_index = start
+
+            # avoid a divide per sample
+            ph += 1
+            if ph == samps_per_sym:
+                ph = 0
+                k += 1
+
+        # flush partial bytes
+        for ph in range(samps_per_sym):
+            n_ph = (len(samples) - ph + samps_per_sym - 1) // samps_per_sym
+            if n_ph & 7:
+                packed[ph, n_ph >> 3] = acc[ph]
+        return nhits
+
+def demod_sync_jit(samples, sync: bytes, samps_per_sym=2, prev=numpy.complex64(0)):
+    samples = numpy.asarray(samples, numpy.complex64)
+    sync_word = numpy.uint32(unpack('<I', sync)[0])
+    prev = numpy.complex64(prev)
+
+    hits = numpy.empty(len(samples) // 256 + 64, numpy.int64)
+    while True:
+        packed = numpy.zeros(_packed_shape(len(samples), samps_per_sym), numpy.uint8)
+        nhits = _demod_sync_kernel(samples, prev.real, prev.imag, sync_word, samps_per_sym, packed, hits)
+        if nhits <= len(hits):
+            return packed, hits[:nhits].tolist()
+        hits = numpy.empty(nhits, numpy.int64)
+
+def demod_sync(samples, sync: bytes, samps_per_sym=2, prev=numpy.complex64(0), use_jit=None):
+    # Returns (packed bits, sync hit sample indices)
+    # use_jit=None uses the Numba kernel when Numba is installed
+    if len(sync) != 4:
+        raise ValueError("Sync word must be 4 bytes")
+    if use_jit is None:
+        use_jit = numba is not None
+    if use_jit:
+        if numba is None:
+            raise ImportError("Numba is required for the JIT demodulator")
+        return demod_sync_jit(samples, sync, samps_per_sym, prev)
+    return demod_sync_numpy(samples, sync, samps_per_sym, prev)
+
+def packed_syms(packed, n, start, count, samps_per_sym=2):
+    # Returns up to count symbols (unpacked) starting at sample index start,
+    # where n is the number of samples the packed bits were sliced from
+    ph = start % samps_per_sym
+    k = start // samps_per_sym
+    count = min(count, _phase_len(n, ph, samps_per_sym) - k)
+    if count <= 0:
+        return numpy.zeros(0, numpy.uint8)
+    row = packed[ph, k >> 3:((k + count + 7) >> 3)]
+    return numpy.unpackbits(row, bitorder='little')[k & 7:(k & 7) + count]
+
+def ble_pkt_extract_packed(packed, n, peaks, chan, samps_per_sym=2):
+    # Same as ble_pkt_extract, but operating on packed bits from demod_sync
+    pkts = []
+    for p in peaks:
+        syms = packed_syms(packed, n, p, 8*MAX_PKT, samps_per_sym)
+        raw = numpy.packbits(syms[32:], bitorder='little')
+        if len(raw) > 2:
+            hdr = le_dewhiten(raw[:2], chan)
+            pkt_len = 5 + hdr[1]
+            pkts.append(le_dewhiten(raw[:pkt_len], chan))
+    return pkts
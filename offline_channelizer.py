@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Written by Sultan Qasim Khan
+# Copyright (c) 2024, NCC Group plc
+# Released as open source under GPLv3
+
+# Parallel channelization of capture files
+#
+# The capture is split into large time shards that are channelized in separate processes.
+# Output column j of the channelizer only depends on input blocks j - taps_per_chan + 1 to j
+# (where a block is channel_count samples), so priming each shard with taps_per_chan blocks
+# of history reproduces the sequential output sample for sample. With the direct filter
+# backend the output is bit identical; the FFT backend rounds differently depending on
+# segment alignment, so matches to complex64 precision.
+
+import numpy
+import concurrent.futures
+import os
+import sys
+from time import time
+
+from channelizer import PolyphaseChannelizer
+
+def _channelize_shard(in_path, out_path, total_cols, col_start, col_end, chunk_sz, chan_args):
+    channelizer = PolyphaseChannelizer(**chan_args)
+    M = channelizer.channel_count
+    samples = numpy.memmap(in_path, numpy.complex64, 'r')
+    out = numpy.memmap(out_path, numpy.complex64, 'r+', shape=(M, total_cols))
+
+    # Pre-roll of taps_per_chan blocks to bring the filter state up to date
+    preroll = min(col_start, channelizer.taps_per_chan)
+    chunk_sz = max(chunk_sz - chunk_sz % M, M)
+    pos = (col_start - preroll) * M
+    end = col_end * M
+    col = col_start - preroll
+    while pos < end:
+        channelized = channelizer.process(samples[pos:min(pos + chunk_sz, end)])
+        pos += chunk_sz
+
+        n = channelized.shape[1]
+        skip = max(col_start - col, 0)
+        if skip < n:
+            out[:, col + skip:col + n] = channelized[:, skip:]
+        col += n
+
+    out.flush()
+    return col_end - col_start
+
+def channelize_file(in_path: str, out_path: str, channel_count: int, taps_per_chan: int = 16,
+                    chan_rel_bw: float = 0.8, backend: str = 'direct', workers: int = None,
+                    shard_cols: int = None, chunk_sz: int = 1 << 22) -> numpy.memmap:
+    # Channelizes a cf32 capture file into a (channel_count x samples) cf32 file
+    # Returns the output as a read-only memory map
+    workers = workers or os.cpu_count()
+
+    # Each shard process runs single threaded, as the shards already occupy every worker
+    chan_args = dict(channel_count=channel_count, taps_per_chan=taps_per_chan,
+                     chan_rel_bw=chan_rel_bw, backend=backend, workers=1)
+
+    # Trailing samples that don't fill a block are dropped, as with PolyphaseChannelizer
+    total_cols = os.path.getsize(in_path) // numpy.dtype(numpy.complex64).itemsize // channel_count
+    out = numpy.memmap(out_path, numpy.complex64, 'w+', shape=(channel_count, total_cols))
+    del out
+
+    # A couple of shards per worker evens out the load, while keeping the pre-roll overhead small
+    if shard_cols is None:
+        shard_cols = max(-(-total_cols // (workers * 2)), chunk_sz // channel_count, 1)
+    shards = [(c, min(c + shard_cols, total_cols)) for c in range(0, total_cols, shard_cols)]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_channelize_shard, in_path, out_path, total_cols, a, b,
+                                   chunk_sz, chan_args) for a, b in shards]
+        for f in futures:
+            f.result()
+
+    return numpy.memmap(out_path, numpy.complex64, 'r', shape=(channel_count, total_cols))
+
+def main(in_path, out_path, channel_count):
+    print("Channelizing %s into %s channels" % (in_path, channel_count))
+    t0 = time()
+    channelized = channelize_file(in_path, out_path, int(channel_count))
+    t1 = time()
+    print("Channelized %d samples per channel in %.3f s" % (channelized.shape[1], t1 - t0))
+
+if __name__ == "__main__":
+    main(*sys.argv[1:4])
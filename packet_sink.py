@@ -0,0 +1,151 @@
+# Written by Sultan Qasim Khan
+# Copyright (c) 2024, NCC Group plc
+# Released as open source under GPLv3
+
+# Buffered packet output
+#
+# Packets are encoded into a large in-memory buffer, and full buffers are handed to a
+# background thread that writes them out, so decoding never waits on the file.
+# Two formats are supported:
+# - pcap with LINKTYPE_BLUETOOTH_LE_LL_WITH_PHDR, which can be opened directly in Wireshark
+# - a compact binary log of (sample index, BLE channel, signal level, packet) records
+
+import numpy
+import queue
+import threading
+from struct import pack, unpack, calcsize
+from time import time
+
+from ble_utils import ble_chan_rf_idx
+
+ADV_AA = 0x8E89BED6
+
+LINKTYPE_BLUETOOTH_LE_LL_WITH_PHDR = 256
+
+# LE_LL_WITH_PHDR flags
+PHDR_DEWHITENED = 0x0001
+PHDR_SIGNAL_VALID = 0x0002
+PHDR_REF_AA_VALID = 0x0010
+
+# sample index, BLE channel, signal level (dBFS), packet length
+LOG_MAGIC = b'BLELOG01'
+LOG_RECORD = '<QBfH'
+
+class PacketSink:
+    # Subclasses define _record(chan, samp_idx, pkt, aa, signal) to encode a packet
+    def __init__(self, path: str, buf_size: int = 1 << 20):
+        self.f = open(path, 'wb')
+        self.buf_size = buf_size
+        self.buf = bytearray()
+        self.count = 0
+        self.error = None
+
+        self._queue = queue.Queue(maxsize=8)
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+        self.buf += self._file_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _file_header(self) -> bytes:
+        return b''
+
+    def _writer(self):
+        while True:
+            buf = self._queue.get()
+            if buf is None:
+                break
+            try:
+                self.f.write(buf)
+            except OSError as e:
+                self.error = e
+
+    def write(self, chan: int, samp_idx: int, pkt: bytes, aa: int = ADV_AA, signal: float = None):
+        # pkt is the dewhitened PDU (header + body + CRC) as returned by ble_pkt_extract
+        self.buf += self._record(chan, samp_idx, pkt, aa, signal)
+        self.count += 1
+        if len(self.buf) >= self.buf_size:
+            self.flush()
+
+    def write_batch(self, records):
+        # records is an iterable of (chan, samp_idx, pkt, aa, signal) tuples
+        for rec in records:
+            self.buf += self._record(*rec)
+            self.count += 1
+        if len(self.buf) >= self.buf_size:
+            self.flush()
+
+    def flush(self):
+        if self.error is not None:
+            raise self.error
+        if self.buf:
+            self._queue.put(bytes(self.buf))
+            self.buf = bytearray()
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        self.f.close()
+        if self.error is not None:
+            raise self.error
+
+class PcapSink(PacketSink):
+    def __init__(self, path: str, fs: float, start_time: float = None, buf_size: int = 1 << 20):
+        # fs is the sample rate that sample indices refer to
+        # start_time is the UNIX time of sample index 0 (defaults to now)
+        self.fs = fs
+        self.start_time = time() if start_time is None else start_time
+        super().__init__(path, buf_size)
+
+    def _file_header(self):
+        return pack('<IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, 65535, LINKTYPE_BLUETOOTH_LE_LL_WITH_PHDR)
+
+    def _record(self, chan, samp_idx, pkt, aa, signal):
+        ts = self.start_time + samp_idx / self.fs
+        ts_sec = int(ts)
+        ts_usec = int((ts - ts_sec) * 1E6)
+
+        flags = PHDR_DEWHITENED | PHDR_REF_AA_VALID
+        if signal is None:
+            signal_power = 0
+        else:
+            # dBFS rather than dBm, as the receive chain is not calibrated
+            signal_power = max(-128, min(127, round(signal)))
+            flags |= PHDR_SIGNAL_VALID
+
+        phdr = pack('<BbbBIH', ble_chan_rf_idx(chan), signal_power, 0, 0, aa, flags)
+        rec_len = len(phdr) + 4 + len(pkt)
+        return pack('<IIII', ts_sec, ts_usec, rec_len, rec_len) + phdr + pack('<I', aa) + pkt
+
+class BinaryLogSink(PacketSink):
+    def _file_header(self):
+        return LOG_MAGIC
+
+    def _record(self, chan, samp_idx, pkt, aa, signal):
+        # The AA is stored in front of the PDU, as on air
+        body = pack('<I', aa) + pkt
+        return pack(LOG_RECORD, samp_idx, chan, numpy.nan if signal is None else signal,
+                    len(body)) + body
+
+def read_binary_log(path: str):
+    # Yields (samp_idx, chan, signal, aa, pkt) for each record of a BinaryLogSink file
+    rec_size = calcsize(LOG_RECORD)
+    with open(path, 'rb') as f:
+        if f.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            raise ValueError("Not a BLE binary log")
+        while True:
+            hdr = f.read(rec_size)
+            if len(hdr) < rec_size:
+                break
+            samp_idx, chan, signal, length = unpack(LOG_RECORD, hdr)
+            body = f.read(length)
+            aa, = unpack('<I', body[:4])
+            yield samp_idx, chan, signal, aa, body[4:]
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+# Written by Sultan Qasim Khan
+# Copyright (c) 2024, NCC Group plc
+# Released as open source under GPLv3
+
+import SoapySDR
+import numpy
+from time import perf_counter
+
+class RFNMSession:
+    def __init__(self, channels=(0,), chunk_sz: int = 1 << 18, args: dict = None,
+                 rate_needs_restart: bool = True):
+        # Long-lived device and RX stream, with cached capabilities and settings
+        # The stream is paused/resumed rather than torn down across reconfiguration
+        self.channels = list(channels)
+        self.chunk_sz = chunk_sz
+
+        # Whether the driver requires the stream to be paused for sample rate changes.
+        # Frequency, gain and bandwidth changes are applied to a running stream.
+        self.rate_needs_restart = rate_needs_restart
+
+        # step name -> list of durations in seconds
+        self.latency = {}
+
+        self._caps = {}
+        self._settings = {}
+        self.stream = None
+        self.active = False
+
+        self.sdr = self._timed("open", SoapySDR.Device, args or dict(driver="rfnm"))
+        self.buffs = [numpy.zeros(chunk_sz, numpy.complex64) for _ in self.channels]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _timed(self, step, func, *args):
+        t0 = perf_counter()
+        ret = func(*args)
+        self.latency.setdefault(step, []).append(perf_counter() - t0)
+        return ret
+
+    def latency_summary(self) -> dict:
+        # step -> (count, mean, max) in seconds
+        return {k: (len(v), sum(v) / len(v), max(v)) for k, v in self.latency.items()}
+
+    # Capability queries (cached)
+
+    def _cap(self, name, func, chan):
+        key = (name, chan)
+        if key not in self._caps:
+            self._caps[key] = self._timed("list_" + name, func, SoapySDR.SOAPY_SDR_RX, chan)
+        return self._caps[key]
+
+    def sample_rates(self, chan: int = 0):
+        return self._cap("sample_rates", self.sdr.listSampleRates, chan)
+
+    def antennas(self, chan: int = 0):
+        return self._cap("antennas", self.sdr.listAntennas, chan)
+
+    def gain_names(self, chan: int = 0):
+        return self._cap("gains", self.sdr.listGains, chan)
+
+    # Settings (only applied when changed)
+
+    def _set(self, name, func, value, *args):
+        changed = False
+        for chan in self.channels:
+            key = (name,) + args + (chan,)
+            if self._settings.get(key) == value:
+                continue
+            self._timed("set_" + name, func, SoapySDR.SOAPY_SDR_RX, chan, *args, value)
+            self._settings[key] = value
+            changed = True
+        return changed
+
+    def set_sample_rate(self, rate: float):
+        if all(self._settings.get(("sample_rate", c)) == rate for c in self.channels):
+            return
+        was_active = self.active
+        if was_active and self.rate_needs_restart:
+            self.pause()
+        self._set("sample_rate", self.sdr.setSampleRate, rate)
+        if was_active and self.rate_needs_restart:
+            self.resume()
+
+    def get_sample_rate(self, chan: int = 0) -> float:
+        return self.sdr.getSampleRate(SoapySDR.SOAPY_SDR_RX, chan)
+
+    def set_antenna(self, antenna: str):
+        self._set("antenna", self.sdr.setAntenna, antenna)
+
+    def set_bandwidth(self, bw: float):
+        self._set("bandwidth", self.sdr.setBandwidth, bw)
+
+    def set_frequency(self, freq: float):
+        self._set("frequency", self.sdr.setFrequency, freq)
+
+    def set_gain(self, gain: float, name: str = None):
+        # Setting the overall gain redistributes it over the named stages, and setting a
+        # named stage changes the overall gain, so forget the cached values of the other kind
+        if name is None:
+            if self._set("gain", self.sdr.setGain, gain):
+                self._forget(lambda k: k[0] == "gain" and len(k) == 3)
+        else:
+            if self._set("gain", self.sdr.setGain, gain, name):
+                self._forget(lambda k: k[0] == "gain" and len(k) == 2)
+
+    def _forget(self, match):
+        for key in [k for k in self._settings if match(k)]:
+            del self._settings[key]
+
+    def set_dc_offset_mode(self, enable: bool):
+        self._set("dc_offset_mode", self.sdr.setDCOffsetMode, enable)
+
+    def configure(self, rate=None, antenna=None, bandwidth=None, freq=None, gain=None,
+                  gain_name=None, dc_offset=None):
+        t0 = perf_counter()
+        if rate is not None:
+            self.set_sample_rate(rate)
+        if antenna is not None:
+            self.set_antenna(antenna)
+        if bandwidth is not None:
+            self.set_bandwidth(bandwidth)
+        if freq is not None:
+            self.set_frequency(freq)
+        if gain is not None:
+            self.set_gain(gain, gain_name)
+        if dc_offset is not None:
+            self.set_dc_offset_mode(dc_offset)
+        self.latency.setdefault("configure", []).append(perf_counter() - t0)
+
+    # Stream control
+
+    def start(self):
+        if self.stream is None:
+            self.stream = self._timed("setup_stream", self.sdr.setupStream,
+                                      SoapySDR.SOAPY_SDR_RX, SoapySDR.SOAPY_SDR_CF32, self.channels)
+        self.resume()
+
+    def resume(self):
+        if self.stream is None:
+            return self.start()
+        if not self.active:
+            ret = self._timed("activate", self.sdr.activateStream, self.stream)
+            if ret != 0:
+                raise RuntimeError("activateStream failed: %s" % SoapySDR.errToStr(ret))
+            self.active = True
+
+    def pause(self):
+        if self.active:
+            self._timed("deactivate", self.sdr.deactivateStream, self.stream)
+            self.active = False
+
+    def close(self):
+        self.pause()
+        if self.stream is not None:
+            self._timed("close_stream", self.sdr.closeStream, self.stream)
+            self.stream = None
+
+    def restart(self, full: bool = False):
+        # Fast path: pause and resume the existing stream.
+        # Tear the stream down if asked to, or if the driver refuses to reactivate it.
+        t0 = perf_counter()
+        step = "full_restart" if full else "restart"
+        self.pause()
+        if not full:
+            try:
+                self.resume()
+            except RuntimeError:
+                full = True
+        if full:
+            self.close()
+            self.start()
+        self.latency.setdefault(step, []).append(perf_counter() - t0)
+
+    def read(self, timeout_us: int = 100000):
+        # Reads one chunk into the preallocated buffers
+        # Returns number of samples read, or a negative SoapySDR error code
+        if self.stream is None:
+            raise RuntimeError("Stream not started, call start() first")
+        sr = self.sdr.readStream(self.stream, self.buffs, self.chunk_sz, timeoutUs=timeout_us)
+        return sr.ret
+
+    def read_full(self, timeout_us: int = 100000, max_restarts: int = 2):
+        # Reads one full chunk, restarting the stream on timeout or error
+        # The first restart just pauses and resumes the stream, later ones tear it down fully
+        # Returns number of samples read (chunk_sz on success)
+        for attempt in range(max_restarts + 1):
+            ret = self.read(timeout_us)
+            if ret == self.chunk_sz:
+                return ret
+            if attempt < max_restarts:
+                self.restart(full=(attempt > 0))
+        return ret
+
+    def retune(self, freq: float, settle_chunks: int = 0):
+        # Changes frequency without stopping the stream
+        # Discards settle_chunks chunks so that returned data is from the new frequency
+        t0 = perf_counter()
+        self.set_frequency(freq)
+        for _ in range(settle_chunks):
+            ret = self.read_full()
+            if ret < 0:
+                raise RuntimeError("readStream failed after retune: %s" % SoapySDR.errToStr(ret))
+            if ret < self.chunk_sz:
+                raise RuntimeError("Short read after retune: %d samples" % ret)
+        self.latency.setdefault("retune", []).append(perf_counter() - t0)
+
+def main():
+    print("Opening RFNM")
+    with RFNMSession() as sess:
+        print("Configuring")
+        sess.configure(rate=sess.sample_rates()[0], antenna=sess.antennas()[0],
+                       bandwidth=80E6, freq=2.1E9, gain=0)
+        sess.start()
+
+        print("Sweeping")
+        for freq in numpy.arange(2.1E9, 2.5E9, 50E6):
+            try:
+                sess.retune(freq, settle_chunks=1)
+            except RuntimeError as e:
+                print("ERROR: %s at %.0f MHz!" % (e, freq / 1E6))
+                continue
+            if sess.read_full() < sess.chunk_sz:
+                print("ERROR: Read timeout at %.0f MHz!" % (freq / 1E6))
+            else:
+                print("Got chunk at %.0f MHz" % (freq / 1E6))
+
+        print("Restarting stream")
+        for i in range(3):
+            sess.restart()
+            sess.read_full()
+
+    print("Step latencies (count, mean ms, max ms):")
+    for step, (n, mean, mx) in sess.latency_summary().items():
+        print("  %-16s %4d %9.3f %9.3f" % (step, n, mean * 1E3, mx * 1E3))
+
+if __name__ == "__main__":
+    main()
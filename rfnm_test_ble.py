@@ -7,6 +7,8 @@ from time import time
 import matplotlib.pyplot as plt
 from struct import pack, unpack
 from ble_utils import *
+from frontend import DecimatingFrontEnd, BurstCollector
+from packet_sink import PcapSink
 
 NUM_CHANNELS = 1
 CHUNK_SZ = 1 << 18
@@ -29,55 +31,58 @@ def main():
         sdr.setGain(SoapySDR.SOAPY_SDR_RX, channel, "RF", 10)
         sdr.setDCOffsetMode(SoapySDR.SOAPY_SDR_RX, channel, True)
 
-    # allocate buffers and files
+    # allocate buffers
     buffs = []
-    captures = []
     samples_to_read = CHUNK_SZ * 500
     for i in range(NUM_CHANNELS):
         buffs.append(numpy.zeros(CHUNK_SZ, numpy.complex64))
-        captures.append(numpy.zeros(samples_to_read, numpy.complex64))
+
+    # filter, decimate and find bursts as samples arrive
+    frontend = DecimatingFrontEnd(sdr.getSampleRate(SoapySDR.SOAPY_SDR_RX, 0))
+    fs = frontend.fs_out
+    collector = BurstCollector()
+    sink = PcapSink("ble_capture_37.pcap", fs)
 
     print("Setting up stream")
     rxStream = sdr.setupStream(SoapySDR.SOAPY_SDR_RX, SoapySDR.SOAPY_SDR_CF32, list(range(NUM_CHANNELS)))
     t_start = time()
     sdr.activateStream(rxStream)
 
-    print("Fetching samples")
+    print("Fetching and decoding samples")
     samples_read = 0
     while samples_read < samples_to_read:
         sr = sdr.readStream(rxStream, buffs, CHUNK_SZ)
-        for i in range(NUM_CHANNELS):
-            captures[i][samples_read:samples_read + sr.ret] = buffs[i][:sr.ret]
-            buffs[i][:] = 0
+        if sr.ret <= 0:
+            continue
+        bursts, starts = collector.process(frontend.process(buffs[0][:sr.ret]))
+        decode_bursts(bursts, starts, fs, sink)
         samples_read += sr.ret
         print("Read %d samples, time %.3f" % (samples_read, sr.timeNs / 1e9), end='\r')
     t_end = time()
 
-    print("Closing stream")
+    print("\nClosing stream")
     sdr.deactivateStream(rxStream)
     sdr.closeStream(rxStream)
 
-    print("Filtering")
-    INIT_DECIM = 4
-    fs = sdr.getSampleRate(SoapySDR.SOAPY_SDR_RX, channel) // INIT_DECIM
-    lpf = scipy.signal.butter(3, 1E6, fs=fs)
-    capf = scipy.signal.lfilter(*lpf, captures[0][::INIT_DECIM])
-    ds = capf[::2]
-    fs //= 2
-
-    print("Extract bursts")
-    bursts = burst_extract(ds)
-
-    print("Demod")
-    for b in bursts:
-        syms = fsk_decode(b, fs, 1E6, True)
-        offset = find_sync32(syms)
-        if offset:
-            data = unpack_syms(syms, offset)
+    # decode any burst still in progress when the capture ended
+    bursts, starts = collector.flush()
+    decode_bursts(bursts, starts, fs, sink)
+    sink.close()
+    print("Wrote %d packets" % sink.count)
+
+def decode_bursts(bursts, starts, fs, sink):
+    if not bursts:
+        return
+
+    syms, sym_counts = fsk_decode_batch(bursts, fs, 1E6, True)
+    offsets = find_sync32_batch(syms, sym_counts)
+    for i, offset in enumerate(offsets):
+        if offset >= 0:
+            data = unpack_syms(syms[i, :sym_counts[i]], offset)
             data_dw = le_dewhiten(data[4:], 37)
             pkt = le_trim_pkt(data_dw)
-            print(hex_str(pkt))
-        elif len(b) > 200:
+            sink.write(37, starts[i], pkt, signal=signal_dbfs(bursts[i]))
+        elif len(bursts[i]) > 200:
             print("sync not found")
 
     """